@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_caption  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def tiny_blip():
+    """A randomly initialised, few-layer BLIP captioning model (no downloads)
+    
+    The wide initializer gives peaked, varied logits, so decoding details
+    such as where the repetition penalty applies change the output.
+    """
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    image_caption.load_ml_modules()
+    import torch
+    
+    config = transformers.BlipConfig(
+        text_config=dict(vocab_size=30524, hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                         intermediate_size=64, encoder_hidden_size=64, initializer_range=0.5),
+        vision_config=dict(hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=64, image_size=64, patch_size=16))
+    torch.manual_seed(0)
+    return transformers.BlipForConditionalGeneration(config).eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tiny_blip, tmp_path_factory):
+    """A model snapshot directory holding tiny_blip as the large registry model"""
+    import transformers
+    
+    root = tmp_path_factory.mktemp("models")
+    vocab = ["[PAD]"] + [f"[unused{i}]" for i in range(99)] + ["[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += [f"w{i}" for i in range(30522 - len(vocab))] + ["[DEC]", "[ENC]"]
+    vocab_file = root / "vocab.txt"
+    vocab_file.write_text("\n".join(vocab) + "\n")
+    
+    snapshot = root / ic_large_name()
+    tokenizer = transformers.BertTokenizerFast(vocab_file=str(vocab_file), do_lower_case=True, bos_token="[DEC]")
+    image_processor = transformers.BlipImageProcessor(size={"height": 64, "width": 64})
+    transformers.BlipProcessor(image_processor=image_processor, tokenizer=tokenizer).save_pretrained(snapshot)
+    tiny_blip.save_pretrained(snapshot)
+    return str(root)
+
+
+def ic_large_name():
+    return image_caption.InstagramCaptionGenerator.MODEL_REGISTRY["large"]
+
+
+@pytest.fixture(scope="session")
+def sample_images(tmp_path_factory):
+    """A few textured JPEGs of different sizes"""
+    np = pytest.importorskip("numpy")
+    from PIL import Image
+    
+    root = tmp_path_factory.mktemp("images")
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(8):
+        pixels = (rng.random((12 + index, 16, 3)) * 255).astype("uint8")
+        path = root / f"image{index}.jpg"
+        Image.fromarray(pixels).resize((640 + 40 * index, 480), Image.BICUBIC).save(path, quality=90)
+        paths.append(str(path))
+    return paths
@@ -0,0 +1,34 @@
+import pytest
+
+import image_caption as ic
+
+
+def _strip_padding(tokens, pad_token_id):
+    tokens = list(map(int, tokens))
+    while tokens and tokens[-1] == pad_token_id:
+        tokens.pop()
+    return tokens
+
+
+@pytest.mark.parametrize("profile", ["fast", "balanced", "quality"])
+def test_onnx_decode_matches_torch(tiny_blip, tmp_path, profile):
+    pytest.importorskip("onnxruntime")
+    import torch
+    
+    kwargs = {"top_p": 0.9, "repetition_penalty": 1.5}
+    kwargs.update(ic.InstagramCaptionGenerator.GENERATION_PROFILES[profile])
+    # A deadline would make the comparison depend on machine speed
+    kwargs["max_time"] = None
+    
+    torch_backend = ic.TorchBlipBackend(tiny_blip)
+    onnx_backend = ic.OnnxBlipBackend(tiny_blip, str(tmp_path))
+    pad_token_id = tiny_blip.config.text_config.pad_token_id
+    input_ids = torch.tensor([[101, 5, 6, 7, 102]])
+    attention_mask = torch.ones_like(input_ids)
+    
+    torch.manual_seed(1)
+    for _ in range(6):
+        image_embeds = torch_backend.encode(torch.randn(1, 3, 64, 64))
+        expected = torch_backend.decode(image_embeds, input_ids, attention_mask, **kwargs)
+        actual = onnx_backend.decode(image_embeds, input_ids, attention_mask, **kwargs)
+        assert _strip_padding(actual[0], pad_token_id) == _strip_padding(expected[0], pad_token_id)
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import image_caption as ic
+
+
+@pytest.fixture(scope="module")
+def generator(tiny_model_dir):
+    return ic.InstagramCaptionGenerator("large", cache_dir=None, model_dir=tiny_model_dir, profile="fast",
+                                        near_duplicate_distance=None)
+
+
+def test_threaded_captions_match_serial(generator, sample_images):
+    paths = sample_images * 4
+    serial = [generator.caption(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        threaded = list(pool.map(generator.caption, paths))
+    
+    for expected, actual in zip(serial, threaded):
+        assert actual.path == expected.path
+        assert actual.blip_caption == expected.blip_caption
+        assert dict(actual.features) == dict(expected.features)
+
+
+def test_near_duplicate_hits_stay_out_of_the_exact_cache(tiny_model_dir, sample_images, tmp_path):
+    from PIL import Image
+    
+    original = sample_images[0]
+    reencoded = str(tmp_path / "reencoded.jpg")
+    Image.open(original).save(reencoded, quality=60)
+    
+    caption_gen = ic.InstagramCaptionGenerator("large", cache_dir=str(tmp_path / "cache"),
+                                               model_dir=tiny_model_dir, profile="fast")
+    caption_gen.caption(original)
+    borrowed = caption_gen.caption(reencoded)
+    assert borrowed.timings["model"] == 0.0
+    assert caption_gen.near_duplicate_stats()["hits"] == 1
+    
+    exact_only = ic.InstagramCaptionGenerator("large", cache_dir=str(tmp_path / "cache"),
+                                              model_dir=tiny_model_dir, profile="fast",
+                                              near_duplicate_distance=None)
+    assert exact_only.caption(reencoded).timings["model"] > 0.0
+
+
+def test_quantized_model_cache_round_trip(tiny_model_dir, sample_images, tmp_path):
+    import torch
+    
+    def load():
+        return ic.InstagramCaptionGenerator("large", cache_dir=str(tmp_path), model_dir=tiny_model_dir,
+                                            profile="fast", quantize=True, near_duplicate_distance=None)
+    
+    first = load()
+    cached = list((tmp_path / "quantized").iterdir())
+    assert len(cached) == 1
+    second = load()
+    assert isinstance(second.model.text_decoder.cls.predictions.decoder,
+                      torch.ao.nn.quantized.dynamic.Linear)
+    for path in sample_images[:3]:
+        first.cache = second.cache = None
+        assert second.caption(path).blip_caption == first.caption(path).blip_caption
+
+
+def test_batch_runs_full_buckets_before_decoding_the_rest(generator, sample_images, monkeypatch):
+    paths = sample_images * 3
+    events = []
+    load_image = generator._load_image
+    caption_loaded = generator._caption_loaded
+    monkeypatch.setattr(generator, "_load_image", lambda path: events.append("load") or load_image(path))
+    monkeypatch.setattr(generator, "_caption_loaded",
+                        lambda batch, *args: events.append(len(batch)) or caption_loaded(batch, *args))
+    
+    results = generator.generate_captions_batch(paths, batch_size=2)
+    
+    assert [result.path for result in results] == paths
+    assert all(size <= 2 for size in events if size != "load")
+    # Generation starts long before the last image is decoded
+    assert events.index(2) < len(paths)
+    for result in results:
+        assert result.blip_caption == generator.caption(result.path).blip_caption
+
+
+def test_results_are_read_only_copies(generator, sample_images):
+    import pickle
+    
+    first = generator.caption(sample_images[0], alternative=True)
+    second = generator.caption(sample_images[0], alternative=True)
+    assert first.features is not second.features
+    for mapping in (first.features, first.captions, first.timings):
+        with pytest.raises(TypeError):
+            mapping["extra"] = 1
+        with pytest.raises(TypeError):
+            mapping.update(extra=1)
+    
+    copy = pickle.loads(pickle.dumps(first))
+    assert copy == first
+    assert isinstance(copy.features, ic.FrozenDict)
+
+
+def test_closing_a_stream_early_stops_the_prefetch_thread(generator, sample_images):
+    import itertools
+    import threading
+    
+    stream = generator.stream_captions_batch(itertools.cycle(sample_images), batch_size=1, prefetch=1)
+    assert next(stream).path == sample_images[0]
+    stream.close()
+    
+    for _ in range(100):
+        if not any(thread.name == "caption-prefetch" for thread in threading.enumerate()):
+            break
+        threading.Event().wait(0.1)
+    assert not any(thread.name == "caption-prefetch" for thread in threading.enumerate())
+
+
+def test_streamed_records_match_batched_ones(generator, sample_images, capsys):
+    import io
+    import json
+    
+    batched, streamed = io.StringIO(), io.StringIO()
+    ic.write_caption_records(generator, sample_images[:3], out=batched)
+    capsys.readouterr()
+    ic.write_caption_records(generator, sample_images[:3], out=streamed, stream=True)
+    
+    records = [json.loads(line) for line in streamed.getvalue().splitlines()]
+    expected = {record["path"]: record for record in map(json.loads, batched.getvalue().splitlines())}
+    assert [record["path"] for record in records] == sample_images[:3]
+    for record in records:
+        assert record["blip_caption"] == expected[record["path"]]["blip_caption"]
+    # The tokens arrive on stderr, one caption per line
+    streamed_lines = capsys.readouterr().err.splitlines()
+    for record in records:
+        assert record["blip_caption"] in streamed_lines
+
+
+def test_batch_paths_use_the_near_duplicate_index(tiny_model_dir, sample_images, tmp_path):
+    from PIL import Image
+    
+    reencoded = str(tmp_path / "reencoded.jpg")
+    Image.open(sample_images[0]).save(reencoded, quality=60)
+    caption_gen = ic.InstagramCaptionGenerator("large", cache_dir=None, model_dir=tiny_model_dir, profile="fast")
+    
+    first = caption_gen.generate_captions_batch([sample_images[0]])[0]
+    borrowed = caption_gen.generate_captions_batch([reencoded])[0]
+    assert borrowed.timings["model"] == 0.0
+    assert borrowed.blip_caption == first.blip_caption
+    streamed = list(caption_gen.stream_captions_batch([reencoded]))[0]
+    assert streamed.timings["model"] == 0.0
+    
+    stats = caption_gen.near_duplicate_stats()
+    assert stats["hits"] == 2
+    assert stats["lookups"] == 3
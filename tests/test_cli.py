@@ -0,0 +1,31 @@
+import pytest
+
+import image_caption as ic
+
+
+@pytest.mark.parametrize("argv", [
+    ["--offline", "--model-dir", "/m", "--profile", "fast", "serve"],
+    ["serve", "--offline", "--model-dir", "/m", "--profile", "fast"],
+    ["--offline", "caption", "--model-dir", "/m", "--profile", "fast", "x.jpg"],
+    ["--profile", "fast", "--model-dir", "/m", "--offline", "batch", "images"],
+    ["--offline", "--model-dir", "/m", "compare", "--profile", "fast", "x.jpg"],
+])
+def test_model_options_before_or_after_the_subcommand(argv):
+    options = ic.generator_options(ic.parse_args(argv))
+    assert options["offline"] is True
+    assert options["model_dir"] == "/m"
+    assert options["profile"] == "fast"
+
+
+@pytest.mark.parametrize("argv", [[], ["serve"], ["caption", "x.jpg"], ["batch", "images"], ["compare", "x.jpg"]])
+def test_model_option_defaults(argv):
+    options = ic.generator_options(ic.parse_args(argv))
+    assert options["offline"] is False
+    assert options["model_dir"] is None
+    assert options["profile"] == "quality"
+    assert options["near_duplicate_distance"] == 4
+
+
+def test_caption_stream_flag():
+    assert ic.parse_args(["caption", "--stream", "x.jpg"]).stream is True
+    assert ic.parse_args(["caption", "x.jpg"]).stream is False
@@ -0,0 +1,62 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import image_caption as ic
+
+SEP, PAD = 102, 0
+
+
+class SlowBeamBackend:
+    """Beam search that always overruns its deadline and cuts off the second row"""
+
+    def __init__(self):
+        self.calls = []
+
+    def decode(self, image_embeds, input_ids, attention_mask, num_beams=1, max_time=None, max_length=20, **kwargs):
+        self.calls.append({"rows": list(image_embeds), "num_beams": num_beams, "max_time": max_time})
+        if num_beams == 1:
+            return [[1, 9, SEP] for _ in image_embeds]
+        time.sleep(max_time)
+        # Finished, cut off (padded), and stopped by max_length
+        return [[1, 5, SEP, PAD], [1, 5, 6, PAD], [1] + [7] * (max_length - 1)]
+
+
+@pytest.fixture
+def deadline_generator():
+    pytest.importorskip("torch")
+    ic.load_ml_modules()
+    caption_gen = object.__new__(ic.InstagramCaptionGenerator)
+    caption_gen.generation_kwargs = {"num_beams": 3, "max_length": 6, "min_length": 1, "max_time": 0.01}
+    return caption_gen
+
+
+def test_deadline_only_redecodes_cut_off_rows(deadline_generator):
+    import torch
+    
+    backend = SlowBeamBackend()
+    tokenizer = SimpleNamespace(sep_token_id=SEP, pad_token_id=PAD)
+    model = SimpleNamespace(backend=backend, processor=SimpleNamespace(tokenizer=tokenizer))
+    image_embeds = torch.arange(3)
+    input_ids = torch.ones(3, 2, dtype=torch.long)
+    
+    caption_ids = deadline_generator._decode_with_deadline(model, image_embeds, input_ids, torch.ones_like(input_ids))
+    
+    # The deadline covers the whole batch, not one image
+    assert backend.calls[0]["max_time"] == pytest.approx(0.03)
+    assert [call["num_beams"] for call in backend.calls] == [3, 1]
+    assert [int(row) for row in backend.calls[1]["rows"]] == [1]
+    assert caption_ids == [[1, 5, SEP, PAD], [1, 9, SEP], [1, 7, 7, 7, 7, 7]]
+
+
+def test_deadline_fallback_with_a_real_model(tiny_model_dir, sample_images):
+    caption_gen = ic.InstagramCaptionGenerator("large", cache_dir=None, model_dir=tiny_model_dir,
+                                               profile="quality", near_duplicate_distance=None)
+    caption_gen.generation_kwargs = dict(caption_gen.generation_kwargs, max_time=1e-6)
+    cut = caption_gen.generate_captions_batch(sample_images[:3], batch_size=3)
+    caption_gen.set_generation_profile("quality")
+    caption_gen.generation_kwargs = dict(caption_gen.generation_kwargs, num_beams=1, max_time=None)
+    greedy = caption_gen.generate_captions_batch(sample_images[:3], batch_size=3)
+    
+    assert [result.blip_caption for result in cut] == [result.blip_caption for result in greedy]
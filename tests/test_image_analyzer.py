@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import image_caption as ic
+
+
+@pytest.fixture
+def photo():
+    pytest.importorskip("cv2")
+    pytest.importorskip("numpy")
+    ic.load_image_modules()
+    return Image.new("RGB", (320, 240), (200, 120, 60))
+
+
+def test_analyzer_without_cascade_support(photo, monkeypatch):
+    monkeypatch.delattr(ic.cv2, "CascadeClassifier")
+    analyzer = ic.ImageAnalyzer()
+    assert analyzer.face_cascade is None
+    assert analyzer.analyze(photo)["has_faces"] is False
+
+
+def test_each_thread_gets_its_own_cascade(photo):
+    analyzer = ic.ImageAnalyzer()
+    if analyzer.face_cascade is None:
+        pytest.skip("face detection is unavailable in this OpenCV build")
+    
+    def cascades():
+        return analyzer.thread_face_cascade(), analyzer.thread_face_cascade()
+    
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        first, again = pool.submit(cascades).result()
+    assert first is again
+    assert first is not analyzer.face_cascade
+    assert analyzer.thread_face_cascade() is analyzer.face_cascade
+
+
+FEATURE_KEYS = {"brightness", "colorful", "orientation", "has_faces", "is_food", "is_nature", "is_urban",
+                "content_type"}
+
+
+@pytest.fixture
+def food_photo():
+    pytest.importorskip("cv2")
+    ic.load_image_modules()
+    np = pytest.importorskip("numpy")
+    # Brownish and dark: food, so edge detection (is_urban) is never needed.
+    # Mild texture keeps its perceptual hash non-zero so it is indexed too.
+    pixels = np.array([70, 55, 35]) + np.random.default_rng(0).integers(-8, 8, (240, 320, 1))
+    return Image.fromarray(pixels.astype("uint8"))
+
+
+def test_lazy_analysis_skips_edge_detection(food_photo, monkeypatch):
+    analyzer = ic.ImageAnalyzer(lazy=True)
+    calls = []
+    monkeypatch.setattr(analyzer, "_detect_urban", lambda gray: calls.append(gray) or False)
+    
+    features = analyzer.analyze(food_photo)
+    assert features["content_type"] == "food"
+    assert features.computed()["is_urban"] is None
+    assert set(features.computed()) == FEATURE_KEYS
+    assert not calls
+    # Reading a skipped feature still computes it
+    assert features["is_urban"] is False
+    assert len(calls) == 1
+
+
+def test_lazy_features_are_not_forced_by_caption_or_json(tiny_model_dir, tmp_path, food_photo, monkeypatch):
+    path = str(tmp_path / "food.jpg")
+    food_photo.save(path)
+    caption_gen = ic.InstagramCaptionGenerator("large", cache_dir=str(tmp_path / "cache"), model_dir=tiny_model_dir,
+                                               profile="fast", lazy_analysis=True)
+    calls = []
+    monkeypatch.setattr(caption_gen.analyzer, "_detect_urban", lambda gray: calls.append(gray) or False)
+    
+    result = caption_gen.caption(path)
+    record = result.to_dict()
+    cached = caption_gen.caption(path).to_dict()
+    
+    assert not calls
+    assert caption_gen.near_duplicate_stats()["entries"] == 1
+    assert set(record["features"]) == FEATURE_KEYS
+    assert record["features"]["is_urban"] is None
+    assert cached["features"] == record["features"]
@@ -0,0 +1,140 @@
+"""ImageFetcher against a local stand-in image server"""
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import image_caption as ic
+
+DELAY = 0.3
+BODIES = {f"/image{index}.jpg": bytes([index]) * (1000 + index) for index in range(8)}
+BODIES["/huge.bin"] = b"\0" * (64 * 1024 + 1)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        body = BODIES.get(path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        time.sleep(DELAY)
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if query == "chunked":
+            # No Content-Length: the size cap has to trip while streaming
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for offset in range(0, len(body), 4096):
+                    chunk = body[offset:offset + 4096]
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+            except OSError:
+                pass
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def server():
+    pytest.importorskip("requests")
+    ic.load_image_modules()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_port}{path}"
+
+
+def test_downloads_overlap(server):
+    fetcher = ic.ImageFetcher(max_workers=8)
+    urls = [url(server, f"/image{index}.jpg") for index in range(8)]
+    start_time = time.perf_counter()
+    bodies = [fetcher.fetch(source) for source in fetcher.lookahead(urls)]
+    elapsed = time.perf_counter() - start_time
+    fetcher.close()
+    
+    assert bodies == [BODIES[f"/image{index}.jpg"] for index in range(8)]
+    # Serially this would take 8 * DELAY
+    assert elapsed < 3 * DELAY
+    assert fetcher.metrics()["downloads"] == 8
+
+
+@pytest.mark.parametrize("query", ["", "?chunked"])
+def test_size_cap(server, query):
+    fetcher = ic.ImageFetcher(max_workers=2, max_bytes=64 * 1024)
+    with pytest.raises(ValueError, match="limit"):
+        fetcher.fetch(url(server, "/huge.bin" + query))
+    assert fetcher.fetch(url(server, "/image1.jpg" + query)) == BODIES["/image1.jpg"]
+    fetcher.close()
+    assert fetcher.metrics()["errors"] == 1
+
+
+def test_etag_revalidation(server, tmp_path):
+    source = url(server, "/image3.jpg")
+    first = ic.ImageFetcher(cache_dir=str(tmp_path))
+    assert first.fetch(source) == BODIES["/image3.jpg"]
+    first.close()
+    
+    second = ic.ImageFetcher(cache_dir=str(tmp_path))
+    assert second.fetch(source) == BODIES["/image3.jpg"]
+    second.close()
+    
+    assert server.requests[0][1] is None
+    assert server.requests[1][1] is not None
+    assert first.metrics()["downloads"] == 1
+    assert second.metrics() == dict(second.metrics(), downloads=0, revalidated=1, bytes=0)
+
+
+def test_http_errors_raise(server):
+    fetcher = ic.ImageFetcher()
+    with pytest.raises(ic.requests.HTTPError):
+        fetcher.fetch(url(server, "/missing.jpg"))
+    fetcher.close()
+
+
+def test_stopping_lookahead_early_cancels_prefetches(server):
+    fetcher = ic.ImageFetcher(max_workers=2)
+    urls = [url(server, f"/image{index}.jpg") for index in range(8)]
+    sources = fetcher.lookahead(iter(urls), depth=2)
+    assert fetcher.fetch(next(sources)) == BODIES["/image0.jpg"]
+    sources.close()
+    
+    # The reader notices within one put timeout and cancels what it started
+    deadline = time.perf_counter() + 2
+    while (any(thread.name == "image-lookahead" for thread in threading.enumerate())
+           and time.perf_counter() < deadline):
+        time.sleep(0.05)
+    assert not any(thread.name == "image-lookahead" for thread in threading.enumerate())
+    assert fetcher.pending == {}
+    fetcher.close()
+    assert len(server.requests) < len(urls)
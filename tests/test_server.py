@@ -0,0 +1,61 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import image_caption as ic
+
+
+@pytest.fixture
+def server():
+    # Malformed requests are rejected before the generator is used
+    server = ic.CaptionServer(("127.0.0.1", 0), caption_gen=None)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("body", [
+    b"not json",
+    b"[1, 2]",
+    b'{"style": "minimal"}',
+    b'{"paths": "abc"}',
+    b'{"paths": ["a.jpg", 3]}',
+    b'{"paths": ["a.jpg"], "style": ["minimal"]}',
+])
+def test_malformed_caption_requests_get_400(server, body):
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/caption", data=body,
+                                     headers={"Content-Type": "application/json"})
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request, timeout=10)
+    assert error.value.code == 400
+    assert "bad request" in json.loads(error.value.read())["error"]
+
+
+def test_metrics_count_near_duplicates_of_served_images(tiny_model_dir, sample_images, tmp_path):
+    from PIL import Image
+    
+    reencoded = str(tmp_path / "reencoded.jpg")
+    Image.open(sample_images[0]).save(reencoded, quality=60)
+    caption_gen = ic.InstagramCaptionGenerator("large", cache_dir=None, model_dir=tiny_model_dir, profile="fast")
+    server = ic.CaptionServer(("127.0.0.1", 0), caption_gen)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        for path in (sample_images[0], reencoded):
+            request = urllib.request.Request(f"{base}/caption", data=json.dumps({"paths": [path]}).encode(),
+                                             headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=60).read()
+        with urllib.request.urlopen(f"{base}/metrics", timeout=10) as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    assert metrics["near_duplicates"]["lookups"] == 2
+    assert metrics["near_duplicates"]["hits"] == 1